@@ -30,4 +30,8 @@ TOKEN_REPLACE = {
     '/?': '?'
 }
 
-TOKEN_PROCESSOR = lambda x: [TOKEN_REPLACE.get(i, i) for i in x]
\ No newline at end of file
+
+def TOKEN_PROCESSOR(x):
+    # a module-level function (not a lambda) so that data sets holding the
+    # parser can be pickled to spawned DataLoader workers
+    return [TOKEN_REPLACE.get(i, i) for i in x]
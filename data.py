@@ -1,12 +1,18 @@
+import gc
 import os
 import re
+import random
+import hashlib
 import logging
+from typing import NamedTuple
 
 import torch
+import numpy as np
 
 import constant as C
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from collections import Counter
+from itertools import accumulate, chain
 
 logger = logging.getLogger()
 
@@ -85,6 +91,146 @@ class ConllParser(object):
 
 
 
+def hash_vocabs(vocabs):
+    """Hash the vocabularies used by NameTaggingDataset.numberize(). The
+    result can be computed once and passed to numberize() for every data set.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    for name in ('token', 'char', 'label', 'form'):
+        key.update(repr(vocabs[name]).encode('utf-8'))
+    return key.hexdigest()
+
+
+class Batch(NamedTuple):
+    """A padded batch returned by NameTaggingDataset.batch_processor()."""
+    token_ids: torch.Tensor
+    char_ids: torch.Tensor
+    label_ids: torch.Tensor
+    seq_lens: torch.Tensor
+    tokens: list
+    labels: list
+
+    def pin_memory(self):
+        """Copy tensor fields to page-locked memory (used by
+        DataLoader(pin_memory=True)). Tokens and labels are kept as is."""
+        return self._replace(token_ids=self.token_ids.pin_memory(),
+                             char_ids=self.char_ids.pin_memory(),
+                             label_ids=self.label_ids.pin_memory(),
+                             seq_lens=self.seq_lens.pin_memory())
+
+    def to(self, device, non_blocking=False):
+        """Move tensor fields to `device`. Sequence lengths stay on the host,
+        where pack_padded_sequence() needs them."""
+        return self._replace(
+            token_ids=self.token_ids.to(device, non_blocking=non_blocking),
+            char_ids=self.char_ids.to(device, non_blocking=non_blocking),
+            label_ids=self.label_ids.to(device, non_blocking=non_blocking))
+
+
+class Prefetcher(object):
+    """Wrap a DataLoader and copy the next batch to the GPU on a side CUDA
+    stream while the current batch is being processed."""
+
+    def __init__(self, loader, device='cuda'):
+        self.loader = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream()
+        self.next_batch = None
+        self._preload()
+
+    def _preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = batch.to(self.device, non_blocking=True)
+
+    def next(self):
+        """Return the prefetched batch (None if the loader is exhausted) and
+        start copying the following one."""
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is not None:
+            # tensors were allocated on the side stream; prevent the caching
+            # allocator from reusing them before the current stream is done
+            for tensor in batch[:3]:
+                tensor.record_stream(current_stream)
+            self._preload()
+        return batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.next()
+        if batch is None:
+            raise StopIteration
+        return batch
+
+
+class BucketSampler(Sampler):
+    """A batch sampler that groups instances of similar lengths to reduce
+    padding. Instances are sorted by length and split into buckets of
+    `bucket_mult * batch_size` instances; each bucket is shuffled and cut into
+    batches, and the order of batches is shuffled.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_mult=50, shuffle=True,
+                 num_replicas=1, rank=0, seed=0):
+        """
+        :param lengths: Sequence length of each instance.
+        :param batch_size: Batch size.
+        :param bucket_mult: Bucket size in batches.
+        :param shuffle: Shuffle instances within buckets and batches.
+        :param num_replicas: Number of processes in distributed training.
+        :param rank: Rank of the current process.
+        :param seed: Random seed, combined with the epoch number.
+        """
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_mult = bucket_mult
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = sorted(range(len(self.lengths)),
+                         key=lambda i: self.lengths[i])
+        bucket_size = self.bucket_mult * self.batch_size
+        batches = []
+        for start in range(0, len(indices), bucket_size):
+            bucket = indices[start:start + bucket_size]
+            if self.shuffle:
+                rng.shuffle(bucket)
+            batches.extend(bucket[i:i + self.batch_size]
+                           for i in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            rng.shuffle(batches)
+        # every process gets the same number of batches; repeat batches
+        # (possibly more than once if there are fewer batches than
+        # processes) up to a multiple of num_replicas
+        if batches:
+            total = len(self) * self.num_replicas
+            batches = (batches * -(-total // len(batches)))[:total]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        batch_num = -(-len(self.lengths) // self.batch_size)
+        return -(-batch_num // self.num_replicas)
+
+
 class NameTaggingDataset(Dataset):
 
     def __init__(self, path, parser, max_seq_len=-1, gpu=True, min_char_len=4, to_bioes=False):
@@ -135,12 +281,94 @@ class NameTaggingDataset(Dataset):
             token_counter.update(inst[0])
         return token_counter
 
-    def numberize(self, vocabs):
+    def _cache_key(self, vocab_key):
+        """Hash the loaded data, settings, and vocabularies that determine
+        the numberized data set. Tokens are hashed after parsing, so changes
+        to the data files and to the parser's processors are both detected.
+        """
+        key = hashlib.blake2b(digest_size=16)
+        key.update(repr((self.max_seq_len, self.to_bioes,
+                         vocab_key)).encode('utf-8'))
+        # fields are tab-separated in the data files and never contain tabs
+        key.update('\n'.join('\t'.join(chain(inst[0], inst[1]))
+                             for inst in self.data).encode('utf-8'))
+        return key.hexdigest()
+
+    def _save_cache(self, data, cache_file):
+        """Save the ids of a numberized data set as flat arrays."""
+        seq_lens = [len(inst[0]) for inst in data]
+        char_lens = [len(chars) for inst in data for chars in inst[1]]
+        arrays = dict(
+            seq_lens=np.array(seq_lens, dtype=np.int64),
+            char_lens=np.array(char_lens, dtype=np.int64),
+            token_ids=np.fromiter(chain.from_iterable(
+                inst[0] for inst in data), dtype=np.int64),
+            char_ids=np.fromiter(chain.from_iterable(
+                chars for inst in data for chars in inst[1]), dtype=np.int64),
+            label_ids=np.fromiter(chain.from_iterable(
+                inst[2] for inst in data), dtype=np.int64))
+        # write to a temporary file first as other processes may be reading
+        # or writing the same cache
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as w:
+            np.savez(w, **arrays)
+        os.replace(tmp_file, cache_file)
+
+    def _load_cache(self, cache_file):
+        """Rebuild a numberized data set from ids saved by _save_cache()."""
+        with np.load(cache_file) as arrays:
+            seq_lens = arrays['seq_lens'].tolist()
+            char_lens = arrays['char_lens'].tolist()
+            token_ids = arrays['token_ids'].tolist()
+            char_ids = arrays['char_ids'].tolist()
+            label_ids = arrays['label_ids'].tolist()
+        # the rebuilt lists hold no reference cycles; collecting while
+        # hundreds of thousands of small lists are created only slows it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            char_ends = list(accumulate(char_lens))
+            char_ids = [char_ids[end - char_len:end]
+                        for char_len, end in zip(char_lens, char_ends)]
+
+            data = []
+            end = 0
+            for inst, seq_len in zip(self.data, seq_lens):
+                start, end = end, end + seq_len
+                tokens, labels = inst[0], inst[1]
+                if self.to_bioes:
+                    labels = bio_to_bioes(labels)
+                data.append((token_ids[start:end], char_ids[start:end],
+                             label_ids[start:end], tokens, labels))
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return data
+
+    def numberize(self, vocabs, cache_dir=None, vocab_key=None):
         """Numberize the data set.
         :param vocabs: A dictionary of vocabularies.
         :param form_map: A mapping table from tokens in the data set to tokens
         in pre-trained word embeddings.
+        :param cache_dir: Directory to cache the ids of the numberized data set
+        in. The cache is reused if the data and vocabularies do not change.
+        Old cache files are not removed, so every change of the data or
+        vocabularies adds a file to this directory.
+        :param vocab_key: Hash of `vocabs` returned by hash_vocabs(); computed
+        if not given.
         """
+        cache_file = None
+        if cache_dir:
+            if vocab_key is None:
+                vocab_key = hash_vocabs(vocabs)
+            cache_file = os.path.join(
+                cache_dir, '{}.npz'.format(self._cache_key(vocab_key)))
+            if os.path.isfile(cache_file):
+                logger.info('Loading numberized data from {}'.format(
+                    cache_file))
+                self.data = self._load_cache(cache_file)
+                return
+
         digit_pattern = re.compile('\d')
 
         token_vocab = vocabs['token']
@@ -178,12 +406,13 @@ class NameTaggingDataset(Dataset):
             data.append((tokens_ids, char_ids, label_ids, tokens, labels))
         self.data = data
 
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._save_cache(data, cache_file)
+
     def batch_processor(self, batch):
         pad = C.PAD_INDEX
 
-        # sort instances in decreasing order of sequence lengths
-        batch.sort(key=lambda x: len(x[0]), reverse=True)
-
         # sequence lengths
         seq_lens = [len(x[0]) for x in batch]
         max_seq_len = max(seq_lens)
@@ -195,36 +424,36 @@ class NameTaggingDataset(Dataset):
                 if len(chars) > max_char_len:
                     max_char_len = len(chars)
 
-        # padding instances
-        batch_token_ids = []
-        batch_char_ids = []
-        batch_label_ids = []
+        # padding instances; arrays are filled in place and shared with the
+        # returned tensors without copying
+        batch_size = len(batch)
+        batch_token_ids = np.full((batch_size, max_seq_len), pad,
+                                  dtype=np.int64)
+        batch_char_ids = np.full((batch_size, max_seq_len, max_char_len), pad,
+                                 dtype=np.int64)
+        batch_label_ids = np.full((batch_size, max_seq_len), pad,
+                                  dtype=np.int64)
         batch_tokens = []
         batch_labels = []
-        for token_ids, char_ids, label_ids, tokens, labels in batch:
+        for i, (token_ids, char_ids, label_ids, tokens, labels) in enumerate(
+                batch):
             seq_len = len(token_ids)
-            pad_num = max_seq_len - seq_len
-            batch_token_ids.append(token_ids + [pad] * pad_num)
-            batch_char_ids.extend(
-                # pad each word
-                [x + [pad] * (max_char_len - len(x)) for x in char_ids] +
-                # pad each sequence
-                [[pad] * max_char_len for _ in range(pad_num)]
-            )
-            batch_label_ids.append(label_ids + [pad] * pad_num)
+            batch_token_ids[i, :seq_len] = token_ids
+            batch_label_ids[i, :seq_len] = label_ids
+            for j, chars in enumerate(char_ids):
+                batch_char_ids[i, j, :len(chars)] = chars
             batch_tokens.append(tokens)
             batch_labels.append(labels)
 
+        batch_token_ids = torch.from_numpy(batch_token_ids)
+        batch_char_ids = torch.from_numpy(
+            batch_char_ids.reshape(-1, max_char_len))
+        batch_label_ids = torch.from_numpy(batch_label_ids)
+        seq_lens = torch.LongTensor(seq_lens)
         if self.gpu:
-            batch_token_ids = torch.cuda.LongTensor(batch_token_ids)
-            batch_char_ids = torch.cuda.LongTensor(batch_char_ids)
-            batch_label_ids = torch.cuda.LongTensor(batch_label_ids)
-            seq_lens = torch.cuda.LongTensor(seq_lens)
-        else:
-            batch_token_ids = torch.LongTensor(batch_token_ids)
-            batch_char_ids = torch.LongTensor(batch_char_ids)
-            batch_label_ids = torch.LongTensor(batch_label_ids)
-            seq_lens = torch.LongTensor(seq_lens)
+            batch_token_ids = batch_token_ids.cuda()
+            batch_char_ids = batch_char_ids.cuda()
+            batch_label_ids = batch_label_ids.cuda()
 
-        return (batch_token_ids, batch_char_ids, batch_label_ids, seq_lens,
-                batch_tokens, batch_labels)
+        return Batch(batch_token_ids, batch_char_ids, batch_label_ids, seq_lens,
+                     batch_tokens, batch_labels)
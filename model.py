@@ -69,7 +69,8 @@ class LstmCnn(nn.Module):
         feats = self.feat_dropout(feats)
 
         # LSTM layer
-        lstm_in = R.pack_padded_sequence(feats, lens.tolist(), batch_first=True)
+        lstm_in = R.pack_padded_sequence(feats, lens.cpu(), batch_first=True,
+                                         enforce_sorted=False)
         lstm_out, _ = self.lstm(lstm_in)
         lstm_out, _ = R.pad_packed_sequence(lstm_out, batch_first=True)
         lstm_out = self.lstm_dropout(lstm_out)
@@ -79,7 +80,11 @@ class LstmCnn(nn.Module):
         return linear_out
 
     def forward(self, token_ids, char_ids, lens, labels):
-        logits = self.forward_nn(token_ids, char_ids, lens)
+        # the CRF runs in fp32 under autocast
+        logits = self.forward_nn(token_ids, char_ids, lens).float()
+        # lengths are kept on the host for packing; the CRF masks need them
+        # on the device of the logits
+        lens = lens.to(logits.device, non_blocking=True)
         logits = self.crf.pad_logits(logits)
         norm_score = self.crf.calc_norm_score(logits, lens)
         gold_score = self.crf.calc_gold_score(logits, labels, lens)
@@ -89,7 +94,8 @@ class LstmCnn(nn.Module):
 
     def predict(self, token_ids, char_ids, lens):
         self.eval()
-        logits = self.forward_nn(token_ids, char_ids, lens)
+        logits = self.forward_nn(token_ids, char_ids, lens).float()
+        lens = lens.to(logits.device, non_blocking=True)
         logits = self.crf.pad_logits(logits)
         _scores, preds = self.crf.viterbi_decode(logits, lens)
         preds = preds.data.tolist()
@@ -258,7 +264,8 @@ class LstmCnnDfc(nn.Module):
         feats = self.feat_dropout(feats)
 
         # LSTM layer
-        lstm_in = R.pack_padded_sequence(feats, lens.tolist(), batch_first=True)
+        lstm_in = R.pack_padded_sequence(feats, lens.cpu(), batch_first=True,
+                                         enforce_sorted=False)
         lstm_out, _ = self.lstm(lstm_in)
         lstm_out, _ = R.pad_packed_sequence(lstm_out, batch_first=True)
         lstm_out = self.lstm_dropout(lstm_out)
@@ -303,6 +310,7 @@ class LstmCnnDfc(nn.Module):
 
     def forward(self, token_ids, char_ids, lens, labels):
         logits = self.forward_nn(token_ids, char_ids, lens)
+        lens = lens.to(logits.device, non_blocking=True)
         logits = self.crf.pad_logits(logits)
         norm_score = self.crf.calc_norm_score(logits, lens)
         gold_score = self.crf.calc_gold_score(logits, labels, lens)
@@ -314,6 +322,7 @@ class LstmCnnDfc(nn.Module):
         self.eval()
 
         logits = self.forward_nn(token_ids, char_ids, lens)
+        lens = lens.to(logits.device, non_blocking=True)
         logits = self.crf.pad_logits(logits)
         _scores, preds = self.crf.viterbi_decode(logits, lens)
         preds = preds.data.tolist()
@@ -416,7 +425,8 @@ class LstmCnnGate(nn.Module):
         feats = self.feat_dropout(feats)
 
         # LSTM layer
-        lstm_in = R.pack_padded_sequence(feats, lens.tolist(), batch_first=True)
+        lstm_in = R.pack_padded_sequence(feats, lens.cpu(), batch_first=True,
+                                         enforce_sorted=False)
         lstm_out, _ = self.lstm(lstm_in)
         lstm_out, _ = R.pad_packed_sequence(lstm_out, batch_first=True)
         lstm_out = self.lstm_dropout(lstm_out)
@@ -447,6 +457,7 @@ class LstmCnnGate(nn.Module):
 
     def forward(self, token_ids, char_ids, lens, labels):
         logits = self.forward_nn(token_ids, char_ids, lens)
+        lens = lens.to(logits.device, non_blocking=True)
         logits = self.crf.pad_logits(logits)
         norm_score = self.crf.calc_norm_score(logits, lens)
         gold_score = self.crf.calc_gold_score(logits, labels, lens)
@@ -458,6 +469,7 @@ class LstmCnnGate(nn.Module):
         self.eval()
 
         logits = self.forward_nn(token_ids, char_ids, lens)
+        lens = lens.to(logits.device, non_blocking=True)
         logits = self.crf.pad_logits(logits)
         _scores, preds = self.crf.viterbi_decode(logits, lens)
         preds = preds.data.tolist()
@@ -532,7 +544,8 @@ class LstmCnnFeatGate(nn.Module):
         feats = gate * word_in + (1 - gate) * char_in
         feats = self.feat_dropout(feats)
         # LSTM layer
-        lstm_in = R.pack_padded_sequence(feats, lens.tolist(), batch_first=True)
+        lstm_in = R.pack_padded_sequence(feats, lens.cpu(), batch_first=True,
+                                         enforce_sorted=False)
         lstm_out, _ = self.lstm(lstm_in)
         lstm_out, _ = R.pad_packed_sequence(lstm_out, batch_first=True)
         lstm_out = self.lstm_dropout(lstm_out)
@@ -542,6 +555,7 @@ class LstmCnnFeatGate(nn.Module):
 
     def forward(self, token_ids, char_ids, lens, labels):
         logits = self.forward_nn(token_ids, char_ids, lens)
+        lens = lens.to(logits.device, non_blocking=True)
         logits = self.crf.pad_logits(logits)
         norm_score = self.crf.calc_norm_score(logits, lens)
         gold_score = self.crf.calc_gold_score(logits, labels, lens)
@@ -551,6 +565,7 @@ class LstmCnnFeatGate(nn.Module):
     def predict(self, token_ids, char_ids, lens):
         self.eval()
         logits = self.forward_nn(token_ids, char_ids, lens)
+        lens = lens.to(logits.device, non_blocking=True)
         logits = self.crf.pad_logits(logits)
         _scores, preds = self.crf.viterbi_decode(logits, lens)
         preds = preds.data.tolist()
@@ -267,7 +267,7 @@ class CRF(nn.Module):
         trn_scr = torch.gather(trn_row, 2, lbl_lexp)
         trn_scr = trn_scr.squeeze(-1)
 
-        mask = sequence_mask(lens + 1).float()
+        mask = sequence_mask(lens + 1, max_len=(seq_len + 1)).float()
         trn_scr = trn_scr * mask
         score = trn_scr
 
@@ -277,7 +277,7 @@ class CRF(nn.Module):
         """Checked"""
         labels_exp = labels.unsqueeze(-1)
         scores = torch.gather(logits, 2, labels_exp).squeeze(-1)
-        mask = sequence_mask(lens).float()
+        mask = sequence_mask(lens, max_len=labels.size(1)).float()
         scores = scores * mask
         return scores
 
@@ -316,48 +316,38 @@ class CRF(nn.Module):
         return norm
 
     def viterbi_decode(self, logits, lens):
-        """Borrowed from pytorch tutorial
+        """Batched Viterbi decoding.
         Arguments:
             logits: [batch_size, seq_len, n_labels] FloatTensor
             lens: [batch_size] LongTensor
         """
         batch_size, seq_len, n_labels = logits.size()
+        device = logits.device
         vit = logits.new_full((batch_size, self.label_size), -100.0)
         vit[:, self.start] = 0
-        c_lens = lens.clone()
+        # transition[to, from] -> [1, from, to]
+        trans = self.transition.t().unsqueeze(0)
+        end_trans = self.transition[self.end].unsqueeze(0)
+        mask = sequence_mask(lens, max_len=seq_len).unsqueeze(-1)
+        # padded steps point back to the same label
+        identity = torch.arange(n_labels, device=device).unsqueeze(0).expand(
+            batch_size, n_labels)
+        backptr = torch.empty((batch_size, seq_len, n_labels),
+                              dtype=torch.long, device=device)
+
+        for t in range(seq_len):
+            vt_max, vt_argmax = (vit.unsqueeze(2) + trans).max(1)
+            vit = torch.where(mask[:, t], vt_max + logits[:, t], vit)
+            backptr[:, t] = torch.where(mask[:, t], vt_argmax, identity)
+            # transition to <EOS> after the last token
+            vit = torch.where((lens == t + 1).unsqueeze(-1),
+                              vit + end_trans, vit)
 
-        logits_t = logits.transpose(1, 0)
-        pointers = []
-        for logit in logits_t:
-            vit_exp = vit.unsqueeze(1).expand(batch_size, n_labels, n_labels)
-            trn_exp = self.transition.unsqueeze(0).expand_as(vit_exp)
-            vit_trn_sum = vit_exp + trn_exp
-            vt_max, vt_argmax = vit_trn_sum.max(2)
-
-            vt_max = vt_max.squeeze(-1)
-            vit_nxt = vt_max + logit
-            pointers.append(vt_argmax.squeeze(-1).unsqueeze(0))
-
-            mask = (c_lens > 0).float().unsqueeze(-1).expand_as(vit_nxt)
-            vit = mask * vit_nxt + (1 - mask) * vit
-
-            mask = (c_lens == 1).float().unsqueeze(-1).expand_as(vit_nxt)
-            vit += mask * self.transition[self.end].unsqueeze(
-                0).expand_as(vit_nxt)
-
-            c_lens = c_lens - 1
-
-        pointers = torch.cat(pointers)
         scores, idx = vit.max(1)
-        paths = [idx.unsqueeze(1)]
-        for argmax in reversed(pointers):
-            idx_exp = idx.unsqueeze(-1)
-            idx = torch.gather(argmax, 1, idx_exp)
-            idx = idx.squeeze(-1)
-
-            paths.insert(0, idx.unsqueeze(1))
-
-        paths = torch.cat(paths[1:], 1)
-        scores = scores.squeeze(-1)
+        paths = torch.empty((batch_size, seq_len), dtype=torch.long,
+                            device=device)
+        for t in range(seq_len - 1, -1, -1):
+            paths[:, t] = idx
+            idx = backptr[:, t].gather(1, idx.unsqueeze(1)).squeeze(1)
 
         return scores, paths
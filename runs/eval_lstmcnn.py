@@ -32,6 +32,10 @@ use_gpu = torch.cuda.is_available()
 
 logger.info('Load model from {}'.format(args.model))
 state = torch.load(args.model)
+if 'vocabs' not in state:
+    # parameters and vocabularies are saved in meta.pt next to the model
+    state.update(torch.load(os.path.join(os.path.dirname(args.model),
+                                         'meta.pt')))
 params = state['params']
 model = LstmCnn(vocabs=state['vocabs'],
                 word_embed_file=None,
@@ -40,9 +44,9 @@ model = LstmCnn(vocabs=state['vocabs'],
                 char_filters=json.loads(params['char_filters']),
                 char_feat_dim=params['char_feat_dim'],
                 lstm_hidden_size=params['lstm_size'],
-                parameters={'word_embed_num': 58002,
-                            'word_embed_dim': 100},
+                parameters=state['model_params'],
                 )
+model.load_state_dict(state['model'])
 if use_gpu:
     model.cuda()
 
@@ -51,7 +55,7 @@ logger.info('Load test data from {}'.format(args.input))
 conll_parser = ConllParser([3, -1], processor={0: C.TOKEN_PROCESSOR})
 test_set = NameTaggingDataset(args.input, conll_parser, gpu=use_gpu)
 test_set.numberize(state['vocabs'])
-label_itos = {i: s for s, i in state['vocabs']['label']}
+label_itos = {i: s for s, i in state['vocabs']['label'].items()}
 
 results = []
 for batch in DataLoader(test_set, batch_size=100, shuffle=False,
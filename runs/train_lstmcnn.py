@@ -5,16 +5,19 @@ import torch
 import random
 import logging
 import numpy as np
+import torch.distributed as dist
 from argparse import ArgumentParser
+from itertools import zip_longest
 
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Subset
 
 import constant as C
 from model import LstmCnn
-from data import ConllParser, NameTaggingDataset
+from data import ConllParser, NameTaggingDataset, Prefetcher, \
+    BucketSampler, hash_vocabs
 from util import build_form_mapping, load_vocab, \
-    calculate_labeling_scores, save_result_file, calculate_lr, \
-    build_fallback_mapping, counter_to_vocab
+    calculate_labeling_scores, save_result_file, calculate_lr
 
 logging.basicConfig(level=logging.INFO,
                     format='%(message)s')
@@ -26,6 +29,9 @@ parser = ArgumentParser()
 parser.add_argument('-i', '--input', help='path to the input directory')
 parser.add_argument('-o', '--output', help='path to the output directory')
 parser.add_argument('-p', '--prefix', default='')
+parser.add_argument('--cache_dir', default='',
+                    help='numberized data cache directory (empty: disable); '
+                         'old cache files are not removed')
 # training parameters
 parser.add_argument('--lr', type=float, default=1e-3, help='learning rate')
 parser.add_argument('-b', '--batch_size', type=int, default=10)
@@ -46,184 +52,321 @@ parser.add_argument('--feat_dropout', type=float, default=.5)
 parser.add_argument('-d', '--device', type=int, default=0,
                     help='GPU device index')
 parser.add_argument('-t', '--thread', type=int, default=1)
+parser.add_argument('--no_amp', action='store_true',
+                    help='disable mixed precision training')
+parser.add_argument('--compile', action='store_true',
+                    help='compile the model with torch.compile')
+parser.add_argument('-w', '--num_workers', type=int, default=-1,
+                    help='number of data loading workers (-1: auto)')
 parser.add_argument('-n', '--note', default='')
-args = parser.parse_args()
-params = vars(args)
-
-# timestamp
-timestamp = time.strftime('%Y%m%d_%H%M%S', time.localtime())
-
-# output
-output_dir = os.path.join(args.output, timestamp)
-os.mkdir(output_dir)
-best_model_file = os.path.join(output_dir, 'model.best.mdl')
-dev_result_file = os.path.join(output_dir, 'result.dev.bio')
-test_result_file = os.path.join(output_dir, 'result.test.bio')
-logger.info('Output directory: {}'.format(output_dir))
-
-# deterministic behavior
-random.seed(args.seed)
-np.random.seed(args.seed)
-torch.manual_seed(args.seed)
-torch.cuda.manual_seed(args.seed)
-
-# set gpu device
-use_gpu = torch.cuda.is_available()
-if use_gpu:
-    torch.cuda.set_device(args.device)
-torch.set_num_threads(args.thread)
-
-# data sets
-conll_parser = ConllParser(
-    # use the 3rd and last column
-    [3, -1],
-    # process the 3rd column with C.TOKEN_PROCESSOR
-    processor={0: C.TOKEN_PROCESSOR})
-train_set = NameTaggingDataset(os.path.join(
-    args.input, '{}train.tsv'.format(args.prefix)),
-    conll_parser, gpu=use_gpu, to_bioes=True)
-dev_set = NameTaggingDataset(os.path.join(
-    args.input, '{}dev.tsv'.format(args.prefix)),
-    conll_parser, gpu=use_gpu, to_bioes=True)
-test_set = NameTaggingDataset(os.path.join(
-    args.input, '{}test.tsv'.format(args.prefix)),
-    conll_parser, gpu=use_gpu, to_bioes=True)
-
-# embedding vocab
-embed_vocab = load_vocab(args.embed_vocab)
-
-# vocabulary
-token_vocab = load_vocab(os.path.join(
-    args.input, '{}token.vocab.tsv'.format(args.prefix)))
-char_vocab = load_vocab(os.path.join(
-    args.input, '{}char.vocab.tsv'.format(args.prefix)))
-label_vocab = load_vocab(os.path.join(
-    args.input, '{}label.vocab.tsv'.format(args.prefix)))
-label_itos = {i: l for l, i in label_vocab.items()}
-form_mapping, token_vocab = build_form_mapping(token_vocab,
-                                               embed_vocab)
-token_fallback_mapping = build_fallback_mapping(token_vocab)
-char_vocab = counter_to_vocab(char_vocab,
-                              offset=len(C.CHAR_PADS),
-                              pads=C.CHAR_PADS)
-token_vocab = counter_to_vocab(token_vocab,
-                               offset=len(C.TOKEN_PADS),
-                               pads=C.TOKEN_PADS)
-vocabs = dict(token=token_vocab,
-              char=char_vocab,
-              label=label_vocab,
-              embed=embed_vocab,
-              form=form_mapping,
-              fallback=token_fallback_mapping)
-
-# numberize data set
-train_set.numberize(vocabs)
-dev_set.numberize(vocabs)
-test_set.numberize(vocabs)
-
-# create model
-batch_step = len(train_set) // args.batch_size
-total_step = batch_step * args.max_epoch
-eval_step = batch_step if args.eval_step == -1 else args.eval_step
-char_filters = json.loads(args.char_filters)
-model = LstmCnn(vocabs=vocabs,
-                word_embed_file=args.embed,
-                word_embed_dim=args.word_dim,
-                char_embed_dim=args.char_dim,
-                char_filters=char_filters,
-                char_feat_dim=args.char_feat_dim,
-                lstm_hidden_size=args.lstm_size,
-                lstm_dropout=args.lstm_dropout,
-                feat_dropout=args.feat_dropout)
-optimizer = torch.optim.Adam(filter(lambda x: x.requires_grad,
-                                    model.parameters()),
-                             lr=args.lr)
-
-if use_gpu:
-    model.cuda()
-
-# state
-best_scores = {
-    'dev': {'p': 0, 'r': 0, 'f': 0}, 'test': {'p': 0, 'r': 0, 'f': 0}}
-state = dict(model=model.state_dict(),
-             optimizer=optimizer.state_dict(),
-             scores=best_scores,
-             params=params,
-             model_params=model.params,
-             vocabs=vocabs)
-
-# training
-global_step = 0
-for epoch in range(args.max_epoch):
-    print('-' * 80)
-    logger.info('Epoch: {}'.format(epoch))
-    start_time = time.time()
-    epoch_loss = []
-    for batch in DataLoader(train_set,
-                            batch_size=args.batch_size,
-                            shuffle=True,
-                            collate_fn=train_set.batch_processor):
-        global_step += 1
-        optimizer.zero_grad()
-        token_ids, char_ids, label_ids, seq_lens, _, _ = batch
-        loglik, _ = model.forward(token_ids, char_ids, seq_lens, label_ids)
-        loss = -loglik.mean()
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 5.0)
-        optimizer.step()
-        epoch_loss.append(loss.item())
-
-        # evaluate the model
-        if global_step % eval_step == 0 or global_step == total_step:
-            # dev set
-            best_epoch = False
-            results = []
-            for batch_dev in DataLoader(dev_set, batch_size=50, shuffle=False,
-                                        collate_fn=dev_set.batch_processor):
-                (token_ids, char_ids, label_ids, seq_lens,
-                 tokens, labels) = batch_dev
-                preds = model.predict(token_ids, char_ids, seq_lens)
-                preds = [[label_itos[l] for l in ls] for ls in preds]
-                results.append((preds, labels, tokens, seq_lens.tolist()))
-            fscore, prec, rec = calculate_labeling_scores(results)
-            logger.info('Dev - P: {:.2f} R: {:.2f} F: {:.2f}'.format(
-                prec, rec, fscore))
-            if fscore > best_scores['dev']['f']:
-                best_epoch = True
-                best_scores['dev'] = {'f': fscore, 'p': prec, 'r': rec}
-                torch.save(state, best_model_file)
-                save_result_file(results, dev_result_file, to_bio=True)
-
-            # test set
-            results = []
-            for batch_test in DataLoader(test_set, batch_size=50, shuffle=False,
-                                         collate_fn=test_set.batch_processor):
-                (token_ids, char_ids, label_ids, seq_lens,
-                 tokens, labels) = batch_test
-                preds = model.predict(token_ids, char_ids, seq_lens)
-                preds = [[label_itos[l] for l in ls] for ls in preds]
-                results.append((preds, labels, tokens, seq_lens.tolist()))
-            fscore, prec, rec = calculate_labeling_scores(results)
-            logger.info('Test - P: {:.2f} R: {:.2f} F: {:.2f}'.format(
-                prec, rec, fscore))
-            if best_epoch:
-                best_scores['test'] = {'f': fscore, 'p': prec, 'r': rec}
-                save_result_file(results, test_result_file, to_bio=True)
-
-            # linear learning rate decay
-            lr = calculate_lr(args.lr, global_step, total_step,
-                              min_lr=0.1 * args.lr)
-            for p in optimizer.param_groups:
-                p['lr'] = lr
-
-    # progress.close()
-    logger.info('Epoch: {} Time: {} Loss: {:.4f}'.format(
-        epoch, int(time.time() - start_time),
-        sum(epoch_loss) / len(epoch_loss)))
-    logger.info('Best dev: P: {:.2f}, R: {:.2f}, F: {:.2f}'.format(
-        best_scores['dev']['p'], best_scores['dev']['r'],
-        best_scores['dev']['f']))
-    logger.info('Best test: P: {:.2f}, R: {:.2f}, F: {:.2f}'.format(
-        best_scores['test']['p'], best_scores['test']['r'],
-        best_scores['test']['f']))
+
+
+def gather_results(results):
+    """Collect evaluation results from all processes. Process `r` evaluates
+    instances r, r + world_size, r + 2 * world_size, ... so the sentences are
+    interleaved back into the order of the data set."""
+    if not dist.is_initialized():
+        return results
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, results)
+    # (pred, label, tokens, seq_len) of each sentence, per process
+    rank_sents = [[sent for batch in rank_results for sent in zip(*batch)]
+                  for rank_results in gathered]
+    sents = [sent for step_sents in zip_longest(*rank_sents)
+             for sent in step_sents if sent is not None]
+    # a single batch holding all sentences
+    return [tuple(zip(*sents))] if sents else []
+
+
+def main():
+    args = parser.parse_args()
+    params = vars(args)
+
+    # set gpu device; multi-gpu training is enabled when the script is
+    # launched with torchrun, which sets LOCAL_RANK for each process
+    use_gpu = torch.cuda.is_available()
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        local_rank = int(os.environ['LOCAL_RANK'])
+        if use_gpu:
+            torch.cuda.set_device(local_rank)
+        dist.init_process_group(backend='nccl' if use_gpu else 'gloo')
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    else:
+        if use_gpu:
+            torch.cuda.set_device(args.device)
+        rank, world_size = 0, 1
+    is_master = rank == 0
+    if not is_master:
+        logger.setLevel(logging.WARNING)
+    device = torch.device('cuda' if use_gpu else 'cpu')
+    torch.set_num_threads(args.thread)
+    # mixed precision; bf16 does not need loss scaling
+    use_amp = use_gpu and not args.no_amp
+    amp_dtype = (torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported()
+                 else torch.float16)
+    scaler = torch.amp.GradScaler(
+        'cuda', enabled=use_amp and amp_dtype == torch.float16)
+
+    # timestamp
+    timestamp = time.strftime('%Y%m%d_%H%M%S', time.localtime())
+    if distributed:
+        timestamp_list = [timestamp]
+        dist.broadcast_object_list(timestamp_list, src=0)
+        timestamp = timestamp_list[0]
+
+    # output
+    output_dir = os.path.join(args.output, timestamp)
+    if is_master:
+        os.mkdir(output_dir)
+    best_model_file = os.path.join(output_dir, 'model.best.mdl')
+    meta_file = os.path.join(output_dir, 'meta.pt')
+    dev_result_file = os.path.join(output_dir, 'result.dev.bio')
+    test_result_file = os.path.join(output_dir, 'result.test.bio')
     logger.info('Output directory: {}'.format(output_dir))
+
+    # deterministic behavior
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.cuda.manual_seed(args.seed)
+
+    num_workers = args.num_workers
+    if num_workers < 0:
+        # half of the cores, shared by the processes on the same node (set
+        # by torchrun) and by the three loaders (train, dev, test) of each
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        num_workers = max(1, (os.cpu_count() or 1) // 2
+                          // (local_world_size * 3))
+    # batches are collated on cpu in worker processes and moved to the gpu in
+    # the training loop, as workers cannot own cuda tensors
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=use_gpu)
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=2)
+
+    # data sets
+    conll_parser = ConllParser(
+        # use the 3rd and last column
+        [3, -1],
+        # process the 3rd column with C.TOKEN_PROCESSOR
+        processor={0: C.TOKEN_PROCESSOR})
+    train_set = NameTaggingDataset(os.path.join(
+        args.input, '{}train.tsv'.format(args.prefix)),
+        conll_parser, gpu=False, to_bioes=True)
+    dev_set = NameTaggingDataset(os.path.join(
+        args.input, '{}dev.tsv'.format(args.prefix)),
+        conll_parser, gpu=False, to_bioes=True)
+    test_set = NameTaggingDataset(os.path.join(
+        args.input, '{}test.tsv'.format(args.prefix)),
+        conll_parser, gpu=False, to_bioes=True)
+
+    # embedding vocab
+    embed_vocab = load_vocab(args.embed_vocab)
+
+    # vocabulary
+    token_vocab = load_vocab(os.path.join(
+        args.input, '{}token.vocab.tsv'.format(args.prefix)))
+    char_vocab = load_vocab(os.path.join(
+        args.input, '{}char.vocab.tsv'.format(args.prefix)))
+    label_vocab = load_vocab(os.path.join(
+        args.input, '{}label.vocab.tsv'.format(args.prefix)))
+    label_itos = {i: l for l, i in label_vocab.items()}
+    # index -> label lookup table for converting whole batches of predictions
+    label_arr = np.array(
+        [label_itos.get(i) for i in range(max(label_itos) + 1)], dtype=object)
+    vocabs = dict(token=token_vocab,
+                  char=char_vocab,
+                  label=label_vocab,
+                  embed=embed_vocab,
+                  form=build_form_mapping(token_vocab))
+
+    # numberize data set
+    cache_dir = os.path.expanduser(args.cache_dir)
+    vocab_key = hash_vocabs(vocabs) if cache_dir else None
+    train_set.numberize(vocabs, cache_dir=cache_dir, vocab_key=vocab_key)
+    dev_set.numberize(vocabs, cache_dir=cache_dir, vocab_key=vocab_key)
+    test_set.numberize(vocabs, cache_dir=cache_dir, vocab_key=vocab_key)
+
+    # each process trains on and evaluates a shard of the data sets
+    # training batches are drawn from buckets of instances of similar lengths
+    train_sampler = BucketSampler([len(inst[0]) for inst in train_set.data],
+                                  args.batch_size,
+                                  num_replicas=world_size,
+                                  rank=rank,
+                                  seed=args.seed)
+    dev_shard, test_shard = dev_set, test_set
+    if distributed:
+        dev_shard = Subset(dev_set, range(rank, len(dev_set), world_size))
+        test_shard = Subset(test_set, range(rank, len(test_set), world_size))
+
+    # create model
+    batch_step = len(train_sampler)
+    total_step = batch_step * args.max_epoch
+    eval_step = batch_step if args.eval_step == -1 else args.eval_step
+    char_filters = json.loads(args.char_filters)
+    model = LstmCnn(vocabs=vocabs,
+                    word_embed_file=args.embed,
+                    word_embed_dim=args.word_dim,
+                    char_embed_dim=args.char_dim,
+                    char_filters=char_filters,
+                    char_feat_dim=args.char_feat_dim,
+                    lstm_hidden_size=args.lstm_size,
+                    lstm_dropout=args.lstm_dropout,
+                    feat_dropout=args.feat_dropout)
+    if use_gpu:
+        model.cuda()
+
+    # fused (gpu) or multi-tensor (cpu) Adam updates all parameters with a
+    # few kernels instead of one loop iteration per parameter
+    trainable_params = [p for p in model.parameters() if p.requires_grad]
+    try:
+        optimizer = torch.optim.Adam(trainable_params, lr=args.lr,
+                                     fused=use_gpu, foreach=not use_gpu)
+    except (TypeError, RuntimeError):
+        # older pytorch versions
+        optimizer = torch.optim.Adam(trainable_params, lr=args.lr)
+    # linear learning rate decay to 0.1 * args.lr
+    scheduler = torch.optim.lr_scheduler.LambdaLR(
+        optimizer,
+        lr_lambda=lambda step: max(0.1, calculate_lr(1.0, step, total_step,
+                                                     min_lr=0.1)))
+    # `model` is used for training, `net` for prediction and saving
+    net = model
+    if distributed:
+        model = DistributedDataParallel(
+            model, device_ids=[local_rank] if use_gpu else None,
+            find_unused_parameters=False)
+    if args.compile and hasattr(torch, 'compile'):
+        # sequence lengths vary from batch to batch
+        torch._dynamo.config.cache_size_limit = 64
+        # only the network is compiled; the CRF loops and the mode switches
+        # and list conversions in predict() would break the graph. Training
+        # and prediction both call forward_nn()
+        net.forward_nn = torch.compile(net.forward_nn, dynamic=True)
+
+    # state; parameters and vocabularies do not change during training and
+    # are saved once, apart from the best model
+    best_scores = {
+        'dev': {'p': 0, 'r': 0, 'f': 0}, 'test': {'p': 0, 'r': 0, 'f': 0}}
+    if is_master:
+        torch.save(dict(params=params,
+                        model_params=net.params,
+                        vocabs=vocabs),
+                   meta_file)
+
+    # data loaders are created once so that their (persistent) workers are
+    # reused across epochs and evaluations
+    train_loader = DataLoader(train_set,
+                              batch_sampler=train_sampler,
+                              collate_fn=train_set.batch_processor,
+                              **loader_kwargs)
+    dev_loader = DataLoader(dev_shard,
+                            batch_size=50,
+                            shuffle=False,
+                            collate_fn=dev_set.batch_processor,
+                            **loader_kwargs)
+    test_loader = DataLoader(test_shard,
+                             batch_size=50,
+                             shuffle=False,
+                             collate_fn=test_set.batch_processor,
+                             **loader_kwargs)
+
+    def predict(loader):
+        """Run the model on a data set and collect the results."""
+        results = []
+        with torch.inference_mode(), \
+                torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+            for batch in loader:
+                batch = batch.to(device, non_blocking=True)
+                token_ids, char_ids, _, seq_lens, tokens, labels = batch
+                preds = net.predict(token_ids, char_ids, seq_lens)
+                preds = label_arr[np.asarray(preds)].tolist()
+                results.append((preds, labels, tokens, seq_lens.tolist()))
+        return gather_results(results)
+
+    # training
+    global_step = 0
+    for epoch in range(args.max_epoch):
+        if is_master:
+            print('-' * 80)
+        logger.info('Epoch: {}'.format(epoch))
+        start_time = time.time()
+        # accumulated on the device to avoid a sync with the host every step
+        epoch_loss = torch.zeros((), device=device)
+        batch_num = 0
+        train_sampler.set_epoch(epoch)
+        train_batches = train_loader
+        if use_gpu:
+            # copy batch i+1 to the gpu while batch i is being processed
+            train_batches = Prefetcher(train_loader, device)
+        for batch in train_batches:
+            global_step += 1
+            optimizer.zero_grad(set_to_none=True)
+            token_ids, char_ids, label_ids, seq_lens, _, _ = batch
+            with torch.autocast(device.type, dtype=amp_dtype,
+                                enabled=use_amp):
+                loglik, _ = model(token_ids, char_ids, seq_lens, label_ids)
+                loss = -loglik.mean()
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 5.0)
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+            epoch_loss += loss.detach()
+            batch_num += 1
+
+            # evaluate the model
+            if global_step % eval_step == 0 or global_step == total_step:
+                # dev set
+                best_epoch = False
+                results = predict(dev_loader)
+                if is_master:
+                    fscore, prec, rec = calculate_labeling_scores(results)
+                    logger.info('Dev - P: {:.2f} R: {:.2f} F: {:.2f}'.format(
+                        prec, rec, fscore))
+                    if fscore > best_scores['dev']['f']:
+                        best_epoch = True
+                        best_scores['dev'] = {'f': fscore, 'p': prec, 'r': rec}
+                        torch.save(dict(model=net.state_dict(),
+                                        optimizer=optimizer.state_dict(),
+                                        scores=best_scores),
+                                   best_model_file)
+                        save_result_file(results, dev_result_file, to_bio=True)
+                if distributed:
+                    best_epoch_list = [best_epoch]
+                    dist.broadcast_object_list(best_epoch_list, src=0)
+                    best_epoch = best_epoch_list[0]
+
+                # test set; only the scores of the best dev epoch are kept,
+                # so it is skipped when the dev score does not improve
+                if best_epoch:
+                    results = predict(test_loader)
+                    if is_master:
+                        fscore, prec, rec = calculate_labeling_scores(results)
+                        logger.info(
+                            'Test - P: {:.2f} R: {:.2f} F: {:.2f}'.format(
+                                prec, rec, fscore))
+                        best_scores['test'] = {'f': fscore, 'p': prec,
+                                               'r': rec}
+                        save_result_file(results, test_result_file,
+                                         to_bio=True)
+
+        # progress.close()
+        logger.info('Epoch: {} Time: {} Loss: {:.4f}'.format(
+            epoch, int(time.time() - start_time),
+            (epoch_loss / batch_num).item()))
+        logger.info('Best dev: P: {:.2f}, R: {:.2f}, F: {:.2f}'.format(
+            best_scores['dev']['p'], best_scores['dev']['r'],
+            best_scores['dev']['f']))
+        logger.info('Best test: P: {:.2f}, R: {:.2f}, F: {:.2f}'.format(
+            best_scores['test']['p'], best_scores['test']['r'],
+            best_scores['test']['f']))
+        logger.info('Output directory: {}'.format(output_dir))
+
+    if distributed:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    main()
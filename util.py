@@ -1,5 +1,6 @@
 import re
 import torch
+from itertools import count, repeat
 import logging
 import conlleval
 import torch.nn as nn
@@ -15,10 +16,8 @@ def counter_to_vocab(counter, offset=0, pads=None, min_count=0):
     :param pads: A list of padding (str, index) pairs.
     :param min_count: Minimum count.
     """
-    vocab = {}
-    for token, freq in counter.items():
-        if freq >= min_count:
-            vocab[token] = len(vocab) + offset
+    tokens = (token for token, freq in counter.items() if freq >= min_count)
+    vocab = dict(zip(tokens, count(offset)))
     if pads:
         for k, v in pads:
             vocab[k] = v
@@ -61,20 +60,21 @@ def build_embedding_vocab(path, skip_first=True):
 def build_form_mapping(vocab: dict,
                           lower_case:bool = True,
                           zero_number:bool = True):
-    form_mapping = {k: k for k, _v in vocab.items()}
+    form_mapping = dict(zip(vocab, vocab))
     if not (lower_case or zero_number):
         return form_mapping
 
+    # derive all forms with map() before merging them in vocab order
     digit_pattern = re.compile('\d')
-    for k in vocab.keys():
-        k_lower = k.lower()
-        if lower_case:
-            if k_lower not in form_mapping:
-                form_mapping[k_lower] = k
-        if zero_number:
-            k_zero = re.sub(digit_pattern, '0', k_lower if lower_case else k)
-            if k_zero not in form_mapping:
-                form_mapping[k_zero] = k
+    tokens = list(vocab)
+    tokens_lower = list(map(str.lower, tokens)) if lower_case else tokens
+    tokens_zero = (list(map(digit_pattern.sub, repeat('0'), tokens_lower))
+                   if zero_number else tokens_lower)
+    for k, k_lower, k_zero in zip(tokens, tokens_lower, tokens_zero):
+        if lower_case and k_lower not in form_mapping:
+            form_mapping[k_lower] = k
+        if zero_number and k_zero not in form_mapping:
+            form_mapping[k_zero] = k
 
     return form_mapping
 
@@ -202,15 +202,116 @@ def calculate_lr(lr, current_step, total_step, min_lr=0):
     return min_lr + (lr - min_lr) * (1 - current_step / total_step)
 
 
-def calculate_labeling_scores(results, report=True):
-    outputs = []
+def _chunk_boundaries(prefix, types):
+    """Vectorized conlleval.start_of_chunk() and conlleval.end_of_chunk() for
+    BIO/BIOES tags.
+    :param prefix: Array of tag prefixes ('B', 'I', 'E', 'S', or 'O').
+    :param types: Array of tag type ids, where 0 is the empty type of 'O'.
+    :return: Boolean arrays indicating whether a chunk starts at each position
+    and whether a chunk ended between each position and the previous one.
+    """
+    prev = np.concatenate([['O'], prefix[:-1]])
+    prev_types = np.concatenate([[0], types[:-1]])
+    type_change = prev_types != types
+
+    prev_in = (prev == 'B') | (prev == 'I')
+    prev_last = (prev == 'E') | (prev == 'S')
+    cur_first = (prefix == 'B') | (prefix == 'S')
+    cur_in = (prefix == 'E') | (prefix == 'I')
+
+    end = (prev_last | (prev_in & (cur_first | (prefix == 'O')))
+           | ((prev != 'O') & type_change))
+    start = (cur_first | ((prev_last | (prev == 'O')) & cur_in)
+             | ((prefix != 'O') & type_change))
+    return start, end
+
+
+def _extract_chunks(prefix, types, type_num):
+    """Extract chunks as (start, end, type) keys encoded in int64."""
+    start, end = _chunk_boundaries(prefix, types)
+    length = len(prefix)
+    starts = np.flatnonzero(start)
+    # a chunk ends at the first boundary after its start
+    ends = np.append(np.flatnonzero(end), length)
+    ends = ends[np.searchsorted(ends, starts, side='right')]
+    chunk_types = types[starts]
+    keys = ((starts.astype(np.int64) * (length + 1) + ends) * type_num
+            + chunk_types)
+    return keys, chunk_types
+
+
+def _count_chunks(results):
+    """Count chunks in the same way as conlleval.evaluate() but with
+    vectorized operations on flattened label arrays. Return None if labels
+    are not in the BIO/BIOES format.
+    """
+    preds, golds = [], []
+    sent_num = 0
     for p_b, g_b, t_b, l_b in results:
         for p_s, g_s, t_s, l_s in zip(p_b, g_b, t_b, l_b):
-            p_s = p_s[:l_s]
-            for p, g, t in zip(p_s, g_s, t_s):
-                outputs.append('{} {} {}'.format(t, g, p))
-            outputs.append('')
-    counts = conlleval.evaluate(outputs)
+            seq_len = min(l_s, len(g_s), len(t_s))
+            # sentences are separated by 'O' as sentence breaks in conlleval
+            preds.extend(p_s[:seq_len])
+            preds.append('O')
+            golds.extend(g_s[:seq_len])
+            golds.append('O')
+            sent_num += 1
+
+    # map label strings to ids once, and ids to prefixes and types
+    labels = sorted(set(preds) | set(golds))
+    label_index = {l: i for i, l in enumerate(labels)}
+    pred_ids = np.fromiter(map(label_index.__getitem__, preds),
+                           dtype=np.int64, count=len(preds))
+    gold_ids = np.fromiter(map(label_index.__getitem__, golds),
+                           dtype=np.int64, count=len(golds))
+    tags = [conlleval.parse_tag(l) for l in labels]
+    if any(p not in ('B', 'I', 'E', 'S') or not t
+           for p, t in tags if p != 'O' or t):
+        return None
+    # the empty type of 'O' is sorted first and gets id 0
+    type_names, label_types = np.unique([t for _, t in tags],
+                                        return_inverse=True)
+    label_prefix = np.array([p for p, _ in tags])
+
+    type_num = len(type_names)
+    pred_keys, pred_types = _extract_chunks(label_prefix[pred_ids],
+                                            label_types[pred_ids], type_num)
+    gold_keys, gold_types = _extract_chunks(label_prefix[gold_ids],
+                                            label_types[gold_ids], type_num)
+    _, correct_idx, _ = np.intersect1d(pred_keys, gold_keys,
+                                       assume_unique=True,
+                                       return_indices=True)
+    correct_types = pred_types[correct_idx]
+
+    counts = conlleval.EvalCounts()
+    counts.correct_chunk = len(correct_idx)
+    counts.found_correct = len(gold_keys)
+    counts.found_guessed = len(pred_keys)
+    # sentence breaks are not counted as tokens
+    counts.token_counter = len(preds) - sent_num
+    counts.correct_tags = int((pred_ids == gold_ids).sum()) - sent_num
+    for attr, chunk_types in (('t_correct_chunk', correct_types),
+                              ('t_found_correct', gold_types),
+                              ('t_found_guessed', pred_types)):
+        type_counts = getattr(counts, attr)
+        for type_idx, type_count in enumerate(np.bincount(chunk_types,
+                                                          minlength=type_num)):
+            if type_count:
+                type_counts[type_names[type_idx]] = int(type_count)
+    return counts
+
+
+def calculate_labeling_scores(results, report=True):
+    counts = _count_chunks(results)
+    if counts is None:
+        outputs = []
+        for p_b, g_b, t_b, l_b in results:
+            for p_s, g_s, t_s, l_s in zip(p_b, g_b, t_b, l_b):
+                p_s = p_s[:l_s]
+                for p, g, t in zip(p_s, g_s, t_s):
+                    outputs.append('{} {} {}'.format(t, g, p))
+                outputs.append('')
+        counts = conlleval.evaluate(outputs)
     overall, by_type = conlleval.metrics(counts)
     if report:
         conlleval.report(counts)